@@ -1,4 +1,5 @@
 import asyncio
+import json
 import os
 import sys
 import aioconsole
@@ -7,6 +8,12 @@ from collections import defaultdict
 SERVER_IP = '172.16.13.89'
 PORT = 12345
 BUFFER_SIZE = 65536
+READ_AHEAD_CHUNKS = 16  # Chunks read from disk ahead of the socket during a directory transfer
+INLINE_FILE_SIZE = 1024 * 1024  # Files up to this size are buffered whole and written in a worker thread
+MAX_PENDING_WRITES = 32  # Concurrent file writes while receiving a directory
+
+# Held while a FILE:/DIR: stream is being written; PONG replies must not interleave with it
+send_lock = asyncio.Lock()
 
 class VectorClock:
     def __init__(self, client_id):
@@ -28,6 +35,186 @@ class VectorClock:
     def __str__(self):
         return str(dict(self.clock))
 
+def build_manifest(root):
+    """Walk a directory tree and return [(relative_path, size), ...] in a stable order.
+
+    Directories with nothing else to send are listed as ``(relative_path + '/', 0)``
+    so the receiver can recreate them.
+    """
+    manifest = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        listed = len(manifest)
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, root).replace(os.sep, '/')
+            try:
+                size = os.path.getsize(path)
+            except OSError as e:
+                # Dangling symlinks and the like have nothing to send
+                print(f"Skipping '{path}': {e}")
+                continue
+            manifest.append((relpath, size))
+        if not dirnames and len(manifest) == listed:
+            manifest.append((os.path.relpath(dirpath, root).replace(os.sep, '/') + '/', 0))
+    return manifest
+
+def iter_file_chunks(path, size):
+    """Yield exactly ``size`` bytes of a file, as listed in the manifest."""
+    remaining = size
+    try:
+        with open(path, "rb") as f:
+            while remaining and (chunk := f.read(min(BUFFER_SIZE, remaining))):
+                remaining -= len(chunk)
+                yield chunk
+    except OSError as e:
+        print(f"Could not read '{path}', sending zeros instead: {e}")
+    # The file shrank, vanished or became unreadable since the manifest was
+    # built; pad it so the stream stays framed
+    while remaining:
+        chunk = bytes(min(BUFFER_SIZE, remaining))
+        remaining -= len(chunk)
+        yield chunk
+
+def iter_manifest_chunks(root, manifest):
+    """Yield the contents of every manifest file back to back, coalesced into BUFFER_SIZE chunks."""
+    pending = bytearray()
+    for relpath, size in manifest:
+        if relpath.endswith('/'):
+            continue  # Directory entry, no contents
+        for chunk in iter_file_chunks(os.path.join(root, relpath), size):
+            pending += chunk
+            if len(pending) >= BUFFER_SIZE:
+                yield bytes(pending)
+                pending.clear()
+    if pending:
+        yield bytes(pending)
+
+async def read_ahead(chunks, queue):
+    """Pull chunks from disk in a worker thread so reads overlap with socket writes."""
+    try:
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            await queue.put(chunk)
+        await queue.put(None)
+    except Exception as e:
+        await queue.put(e)
+
+async def stream_directory(writer, dirname, clock):
+    """Write a DIR: header, the manifest and all file contents as a single stream."""
+    manifest = await asyncio.to_thread(build_manifest, dirname)
+    total = sum(size for _, size in manifest)
+    lines = [
+        f"DIR:{os.path.basename(os.path.normpath(dirname))}:{clock}",
+        f"MANIFEST:{len(manifest)}:{total}",
+    ]
+    lines += [f"{size}:{relpath}" for relpath, size in manifest]
+    writer.write(("\n".join(lines) + "\n").encode())
+
+    queue = asyncio.Queue(maxsize=READ_AHEAD_CHUNKS)
+    read_task = asyncio.create_task(read_ahead(iter_manifest_chunks(dirname, manifest), queue))
+    try:
+        while (chunk := await queue.get()) is not None:
+            if isinstance(chunk, Exception):
+                # The peer is mid-stream and can't resync; make it see EOF
+                writer.transport.abort()
+                raise chunk
+            writer.write(chunk)
+            await writer.drain()
+    finally:
+        read_task.cancel()
+
+    # Signal end of directory with special marker
+    writer.write(b'ENDOFDIR\n')
+    await writer.drain()
+    return len(manifest), total
+
+def safe_relpath(relpath):
+    """Reject manifest paths that would escape the destination directory."""
+    path = os.path.normpath(relpath)
+    if os.path.isabs(path) or path == os.pardir or path.startswith(os.pardir + os.sep):
+        raise ValueError(f"Unsafe path in manifest: {relpath}")
+    return path
+
+def write_file(path, data):
+    """Write a whole file, creating parent directories as needed."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+async def receive_directory(reader, dirname):
+    """Read a manifest and file stream after a DIR: header, writing files in parallel."""
+    root = "received_" + os.path.basename(dirname)
+    header = (await reader.readline()).decode().strip()
+    if not header.startswith("MANIFEST:"):
+        raise ValueError(f"Expected manifest, got: {header}")
+    _, count, total = header.split(':')
+    manifest = []
+    for _ in range(int(count)):
+        size, relpath = (await reader.readline()).decode().rstrip('\n').split(':', 1)
+        # A trailing '/' marks a directory to create rather than a file
+        manifest.append((safe_relpath(relpath), None if relpath.endswith('/') else int(size)))
+
+    writes = set()
+    failures = []  # Write errors, raised only after the whole stream is read so it stays framed
+    slots = asyncio.Semaphore(MAX_PENDING_WRITES)
+    try:
+        for relpath, size in manifest:
+            path = os.path.join(root, relpath)
+            if size is None:
+                try:
+                    await asyncio.to_thread(os.makedirs, path, exist_ok=True)
+                except OSError as e:
+                    failures.append(e)
+            elif size <= INLINE_FILE_SIZE:
+                data = await reader.readexactly(size)
+                await slots.acquire()
+
+                def written(task):
+                    slots.release()
+                    if not task.cancelled() and task.exception() is not None:
+                        failures.append(task.exception())
+
+                task = asyncio.create_task(asyncio.to_thread(write_file, path, data))
+                writes.add(task)
+                task.add_done_callback(writes.discard)
+                task.add_done_callback(written)
+            else:
+                # Large files are streamed to disk rather than held in memory
+                try:
+                    await asyncio.to_thread(os.makedirs, os.path.dirname(path), exist_ok=True)
+                    f = await asyncio.to_thread(open, path, "wb")
+                except OSError as e:
+                    failures.append(e)
+                    f = None
+                try:
+                    remaining = size
+                    while remaining:
+                        chunk = await reader.readexactly(min(BUFFER_SIZE, remaining))
+                        remaining -= len(chunk)
+                        if f is None:
+                            continue  # Keep reading so the stream stays framed
+                        try:
+                            await asyncio.to_thread(f.write, chunk)
+                        except OSError as e:
+                            failures.append(e)
+                            await asyncio.to_thread(f.close)
+                            f = None
+                finally:
+                    if f is not None:
+                        await asyncio.to_thread(f.close)
+
+        trailer = await reader.readline()
+        if trailer != b'ENDOFDIR\n':
+            raise ValueError("Directory stream missing ENDOFDIR marker")
+        await asyncio.gather(*writes, return_exceptions=True)
+        if failures:
+            print(f"{len(failures)} file(s) in '{dirname}' could not be written")
+            raise failures[0]
+    finally:
+        for task in writes:
+            task.cancel()
+    return root, len(manifest), int(total)
+
 async def send_file(writer, filename, vector_clock):
     """Send a file to the server in chunks."""
     if os.path.exists(filename):
@@ -48,15 +235,60 @@ async def send_file(writer, filename, vector_clock):
     else:
         print("File not found.")
 
+async def send_directory(writer, dirname, vector_clock):
+    """Send a whole directory tree to the server as one batched stream."""
+    if os.path.isdir(dirname):
+        vector_clock.increment()
+        count, total = await stream_directory(writer, dirname, vector_clock.get_clock())
+        print(f"Sent directory: {dirname} ({count} files, {total} bytes)")
+    else:
+        print("Directory not found.")
+
 async def sender(writer, vector_clock):
     """Handle sending messages and files to the server."""
     try:
         while True:
-            message = await aioconsole.ainput("Enter message (or 'send file' to transfer a file, 'exit' to quit): ")
+            message = await aioconsole.ainput(
+                "Enter message (or 'send file' / 'send dir' to transfer, 'history' for past messages, "
+                "'join #channel' / 'leave #channel', '#channel message' to publish, 'exit' to quit): "
+            )
             
             if message.lower() == "send file":
                 filename = await aioconsole.ainput("Enter filename to send: ")
-                await send_file(writer, filename, vector_clock)
+                async with send_lock:
+                    await send_file(writer, filename, vector_clock)
+            elif message.lower() == "send dir":
+                dirname = await aioconsole.ainput("Enter directory to send: ")
+                async with send_lock:
+                    try:
+                        await send_directory(writer, dirname, vector_clock)
+                    except OSError as e:
+                        print(f"Could not send directory: {e}")
+            elif message.lower() == "history":
+                query = await aioconsole.ainput("Enter 'last N', 'since' (messages you haven't seen) or 'user NAME N': ")
+                words = query.split()
+                if len(words) == 2 and words[0] == "last" and words[1].isdigit():
+                    writer.write(f"HISTORY:LAST:{words[1]}".encode() + b'\n')
+                elif words == ["since"]:
+                    writer.write(f"HISTORY:SINCE:{vector_clock.get_clock()}".encode() + b'\n')
+                elif len(words) == 3 and words[0] == "user" and words[2].isdigit():
+                    writer.write(f"HISTORY:USER:{words[1]}:{words[2]}".encode() + b'\n')
+                else:
+                    print("Invalid history query.")
+                    continue
+                await writer.drain()
+                continue
+            elif message.lower().startswith(("join #", "leave #")):
+                command, _, channel = message.partition(' #')
+                writer.write(f"{command.upper()}:{channel.strip()}".encode() + b'\n')
+                await writer.drain()
+                continue
+            elif message.startswith("#") and " " in message:
+                channel, _, text = message[1:].partition(' ')
+                vector_clock.increment()
+                writer.write(f"PUB:{channel}:{text}:{vector_clock.get_clock()}".encode() + b'\n')
+                await writer.drain()
+                continue
             else:
                 vector_clock.increment()
                 writer.write(f"MSG:{message}:{vector_clock.get_clock()}".encode() + b'\n')
@@ -68,7 +300,7 @@ async def sender(writer, vector_clock):
     except asyncio.CancelledError:
         pass
 
-async def receiver(reader, vector_clock):
+async def receiver(reader, writer, vector_clock):
     """Handle receiving messages and files from the server."""
     try:
         while True:
@@ -94,6 +326,20 @@ async def receiver(reader, vector_clock):
                 print(f"Received file: received_{filename}")
                 vector_clock.update(sender_clock)
             
+            elif message.startswith("DIR:"):
+                parts = message.split(':', 2)
+                dirname = parts[1]
+                sender_clock = eval(parts[2])
+                print(f"\nReceiving directory: {dirname}")
+                try:
+                    root, count, total = await receive_directory(reader, dirname)
+                except OSError as e:
+                    # The stream was read to its end, so the connection is still usable
+                    print(f"Failed to save directory '{dirname}': {e}")
+                else:
+                    print(f"Received directory: {root} ({count} files, {total} bytes)")
+                vector_clock.update(sender_clock)
+            
             elif message.startswith("MSG:"):
                 parts = message.split(':', 2)
                 msg = parts[1]
@@ -101,6 +347,28 @@ async def receiver(reader, vector_clock):
                 print(f"\nServer: {msg}")
                 vector_clock.update(sender_clock)
             
+            elif message.startswith("CHAN:"):
+                # CHAN:<channel>:<sender>:<message>:<clock>; the clock is the last ':{...}'
+                channel, sender_name, rest = message[5:].split(':', 2)
+                split = rest.rfind(':{')
+                sender_clock = eval(rest[split + 1:])
+                print(f"\n#{channel} {sender_name}: {rest[:split]}")
+                vector_clock.update(sender_clock)
+            
+            elif message == "PING":
+                # Server heartbeat; an upload in progress already shows we are alive
+                if not send_lock.locked():
+                    writer.write(b"PONG\n")
+                    await writer.drain()
+            
+            elif message.startswith("HIST:"):
+                seq, username, msg, sender_clock = json.loads(message[5:])
+                print(f"\n[{seq}] {username}: {msg}")
+                vector_clock.update(sender_clock)
+            
+            elif message.startswith("ENDOFHISTORY:"):
+                print(f"\nEnd of history ({message[13:]} messages)")
+            
             elif message.startswith("ERROR:"):
                 print(f"\nServer Error: {message[6:]}")
                 return  # Exit if there's an error
@@ -132,7 +400,7 @@ async def client():
         await asyncio.sleep(0.5)
         
         send_task = asyncio.create_task(sender(writer, vector_clock))
-        receive_task = asyncio.create_task(receiver(reader, vector_clock))
+        receive_task = asyncio.create_task(receiver(reader, writer, vector_clock))
 
         try:
             # Wait for either task to finish (like when the user types 'exit')
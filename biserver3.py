@@ -1,12 +1,42 @@
 import asyncio
+import bisect
+import json
+import math
+import mmap
 import os
 import sys
+import time
 import aioconsole
+from array import array
 from collections import defaultdict
 
 HOST = '0.0.0.0'  # Listen on all interfaces
 PORT = 12345
 BUFFER_SIZE = 65536
+READ_AHEAD_CHUNKS = 16  # Chunks read from disk ahead of the socket during a directory transfer
+INLINE_FILE_SIZE = 1024 * 1024  # Files up to this size are buffered whole and written in a worker thread
+MAX_PENDING_WRITES = 32  # Concurrent file writes while receiving a directory
+HISTORY_DIR = 'history'  # Where the message log segments are stored
+SEGMENT_SIZE = 16 * 1024 * 1024  # Start a new log segment once the current one reaches this size
+INDEX_INTERVAL = 64  # Records between entries in the sparse offset index
+COMMIT_INTERVAL = 0.005  # Seconds to collect messages into one group commit
+HISTORY_BATCH = 256  # History records written between drains
+MAX_LINE_SIZE = BUFFER_SIZE  # Longest line (and FILE: transfer) accepted from a client
+MAX_MANIFEST_FILES = 100000  # Most files accepted in one directory transfer
+MAX_MANIFEST_BYTES = 4 * 1024 * 1024  # Largest directory manifest accepted, held in memory for the transfer
+MSG_RATE = 20  # Sustained lines per second per user
+MSG_BURST = 50
+BYTE_RATE = 8 * 1024 * 1024  # Sustained bytes per second per user, including transfers
+BYTE_BURST = 16 * 1024 * 1024
+MAX_RATE_LIMITS = 10000  # Users whose rate limits are remembered across reconnects
+MEMORY_BUDGET = 256 * 1024 * 1024  # Client data held in memory across all connections
+HEARTBEAT_INTERVAL = 10  # Seconds of silence before a client is pinged
+IDLE_TIMEOUT = 30  # Silent clients are evicted within IDLE_TIMEOUT + HEARTBEAT_INTERVAL seconds
+WRITE_TIMEOUT = 15  # Seconds a drain() may stall before the connection is aborted
+MAX_DEFERRED_LINES = 1000  # Lines held back per client while a file or directory is being sent to it
+TIMER_TICK = 0.1  # Timer wheel resolution in seconds
+TIMER_SLOTS = 64  # Slots per timer wheel level
+TIMER_LEVELS = 4  # Wheel levels; covers TIMER_TICK * TIMER_SLOTS ** TIMER_LEVELS seconds
 
 # Dictionary to store active clients {username: (reader, writer, client_id, vector_clock)}
 active_clients = {}
@@ -31,14 +61,701 @@ class VectorClock:
     def __str__(self):
         return str(dict(self.clock))
 
+class MessageLog:
+    """Segmented append-only log of MSG: traffic with sparse and per-user indexes.
+
+    Each record is one JSON line ``[seq, username, message, clock]``. Appends are
+    validated and serialised straight away, then written by ``run()`` in group
+    commits (one write and one fsync per batch), so the live message path never
+    waits on the disk. Sequence numbers are assigned at commit, so a failed
+    batch leaves no gaps. Reads go through read-only memory maps of the
+    committed part of each segment.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = []  # Segment file paths, oldest first
+        self.sizes = []  # Committed bytes per segment
+        self.maps = {}  # segment -> (size, mmap) of the committed bytes
+        self.sparse_index = []  # [(seq, segment, offset)]
+        # client -> ([checkpoint, ...], [max timestamp of all records before it, ...]), only
+        # recorded at checkpoints where that component grew, so both lists are increasing
+        self.clock_index = {}
+        self.changed = {}  # Components of max_clock that grew since the last checkpoint
+        self.user_index = defaultdict(lambda: array('Q'))  # username -> packed (segment, offset)
+        self.max_clock = {}  # Componentwise max of every committed clock
+        self.committed_seq = 0  # Records below this are on disk and queryable
+        self.pending = []  # [(username, clock, serialised record without its seq)]
+        self.has_pending = asyncio.Event()
+        self.file = None
+
+    def load(self):
+        """Open the log directory and rebuild the in-memory indexes from disk."""
+        os.makedirs(self.directory, exist_ok=True)
+        for name in sorted(n for n in os.listdir(self.directory) if n.endswith('.log')):
+            path = os.path.join(self.directory, name)
+            segment = len(self.segments)
+            self.segments.append(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+            offset = 0
+            for line in data.splitlines(keepends=True):
+                if not line.endswith(b'\n'):
+                    break  # Torn write from a crash; dropped below
+                seq, username, _, clock = json.loads(line)
+                self._index(seq, username, clock, segment, offset)
+                offset += len(line)
+            if offset != len(data):
+                os.truncate(path, offset)
+            self.sizes.append(offset)
+        if self.segments:
+            self.file = open(self.segments[-1], 'ab', buffering=0)
+        else:
+            self._roll(0)
+        print(f"Message log loaded: {self.committed_seq} messages in {len(self.segments)} segment(s)")
+
+    def _roll(self, first_seq):
+        """Start a new segment named after the first sequence number it will hold."""
+        path = os.path.join(self.directory, f"{first_seq:020d}.log")
+        if self.segments and self.segments[-1] == path:
+            # Replacing a torn segment that holds no records yet; sort after it
+            path = os.path.join(self.directory, f"{first_seq:020d}_{len(self.segments):06d}.log")
+        # Open before closing, so a failed roll leaves the current segment in use
+        new_file = open(path, 'ab', buffering=0)
+        if self.file:
+            self.file.close()
+        self.file = new_file
+        self.segments.append(path)
+        self.sizes.append(0)
+
+    def _index(self, seq, username, clock, segment, offset):
+        """Add a committed record to the sparse, per-user and clock indexes."""
+        if not self.sparse_index or seq - self.sparse_index[-1][0] >= INDEX_INTERVAL:
+            checkpoint = len(self.sparse_index)
+            for client, timestamp in self.changed.items():
+                checkpoints, timestamps = self.clock_index.setdefault(client, ([], []))
+                checkpoints.append(checkpoint)
+                timestamps.append(timestamp)
+            self.changed.clear()
+            self.sparse_index.append((seq, segment, offset))
+        self.user_index[username].append(segment << 40 | offset)
+        for client, timestamp in clock.items():
+            if timestamp > self.max_clock.get(client, 0):
+                self.max_clock[client] = timestamp
+                self.changed[client] = timestamp
+        self.committed_seq = seq + 1
+
+    def append(self, username, message, clock):
+        """Queue a message for the next group commit; raises ValueError for a record that can't be logged."""
+        if not all(isinstance(client, str) and type(timestamp) is int for client, timestamp in clock.items()):
+            raise ValueError(f"Clock must map client ids to integers: {clock}")
+        body = json.dumps([username, message, clock])
+        self.pending.append((username, clock, body[1:]))
+        self.has_pending.set()
+
+    def _write(self, data, committed):
+        """Append and fsync a batch; on failure, cut the segment back to its committed size."""
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[self.file.write(view):]
+            os.fsync(self.file.fileno())
+        except OSError:
+            # Drop any torn bytes so the next batch starts on a record boundary
+            os.ftruncate(self.file.fileno(), committed)
+            raise
+
+    async def run(self):
+        """Write queued messages to disk in batches, forever."""
+        while True:
+            await self.has_pending.wait()
+            # Let messages arriving in the same window share one write and fsync
+            await asyncio.sleep(COMMIT_INTERVAL)
+            batch, self.pending = self.pending, []
+            self.has_pending.clear()
+            first_seq = self.committed_seq
+            lines = [f"[{seq}, {body}\n".encode() for seq, (_, _, body) in enumerate(batch, first_seq)]
+            try:
+                if self.sizes[-1] >= SEGMENT_SIZE:
+                    self._roll(first_seq)
+                await asyncio.to_thread(self._write, b''.join(lines), self.sizes[-1])
+            except Exception as e:
+                print(f"Error writing message log, {len(batch)} message(s) lost: {e}")
+                try:
+                    if os.fstat(self.file.fileno()).st_size != self.sizes[-1]:
+                        # Couldn't cut the torn bytes off; never append after them
+                        self._roll(first_seq)
+                except Exception as e:
+                    print(f"Error recovering message log: {e}")
+                continue
+            segment, offset = len(self.segments) - 1, self.sizes[-1]
+            for seq, (username, clock, _), line in zip(range(first_seq, first_seq + len(batch)), batch, lines):
+                self._index(seq, username, clock, segment, offset)
+                offset += len(line)
+            self.sizes[segment] = offset
+
+    def _map(self, segment):
+        """Return a read-only mmap of the committed part of a segment, or None if empty."""
+        size = self.sizes[segment]
+        if not size:
+            return None
+        cached = self.maps.get(segment)
+        if cached is None or cached[0] != size:
+            # Older maps of a growing segment are left to the garbage collector,
+            # since a query that is still streaming may hold a reference
+            with open(self.segments[segment], 'rb') as f:
+                cached = (size, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ))
+            self.maps[segment] = cached
+        return cached[1]
+
+    def _read_line(self, segment, offset):
+        m = self._map(segment)
+        return m[offset:m.find(b'\n', offset) + 1]
+
+    def _scan(self, segment, offset):
+        """Yield raw record lines from a position to the end of the committed log."""
+        while segment < len(self.segments):
+            m = self._map(segment)
+            while m is not None and offset < len(m):
+                end = m.find(b'\n', offset) + 1
+                yield m[offset:end]
+                offset = end
+            segment, offset = segment + 1, 0
+
+    def last(self, count):
+        """Yield the most recent ``count`` records, oldest first."""
+        first = max(0, self.committed_seq - count)
+        end = self.committed_seq
+        i = bisect.bisect_right(self.sparse_index, first, key=lambda entry: entry[0]) - 1
+        if i < 0:
+            return
+        _, segment, offset = self.sparse_index[i]
+        for line in self._scan(segment, offset):
+            seq = int(line[1:line.index(b',')])
+            if seq >= end:
+                break
+            if seq >= first:
+                yield line
+
+    def since(self, clock):
+        """Yield every record whose clock is not covered by ``clock``."""
+        def covered(other):
+            return all(timestamp <= clock.get(client, 0) for client, timestamp in other.items())
+
+        if not self.sparse_index:
+            return
+        # Running max clocks only grow, so the checkpoints covered by ``clock``
+        # form a prefix of the sparse index. It ends at the first checkpoint
+        # where any component passes ``clock``; start from the one before
+        uncovered = len(self.sparse_index)
+        for client, (checkpoints, timestamps) in self.clock_index.items():
+            i = bisect.bisect_right(timestamps, clock.get(client, 0))
+            if i < len(checkpoints):
+                uncovered = min(uncovered, checkpoints[i])
+        _, segment, offset = self.sparse_index[uncovered - 1]
+        end = self.committed_seq
+        for line in self._scan(segment, offset):
+            seq, _, _, record_clock = json.loads(line)
+            if seq >= end:
+                break
+            if not covered(record_clock):
+                yield line
+
+    def user_last(self, username, count):
+        """Yield the most recent ``count`` records sent by one user, oldest first."""
+        positions = self.user_index.get(username, ())
+        for position in positions[max(0, len(positions) - count):] if count else ():
+            yield self._read_line(position >> 40, position & (1 << 40) - 1)
+
+# Message history shared by all connections; loaded and committed from main()
+history = MessageLog(HISTORY_DIR)
+
+class TokenBucket:
+    """Rate limiter for one user; waiting for tokens pauses reads from that client only."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def consume(self, amount):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # Go into debt and sleep it off, so requests larger than the burst still get through
+        self.tokens -= amount
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+class MemoryBudget:
+    """Global cap on client data held in memory; readers wait while it is exhausted."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.freed = asyncio.Event()
+
+    async def reserve(self, amount):
+        # An oversized request still proceeds once nothing else is in flight
+        while self.used and self.used + amount > self.limit:
+            self.freed.clear()
+            await self.freed.wait()
+        self.used += amount
+
+    def release(self, amount):
+        self.used -= amount
+        self.freed.set()
+
+# Shared by all connections
+memory_budget = MemoryBudget(MEMORY_BUDGET)
+
+class Liveness:
+    """When a connection last showed signs of life, and whether the server is holding up its reads."""
+
+    def __init__(self):
+        self.last_seen = time.monotonic()
+        self.holds = 0  # Server-side waits in progress; the client can't be judged silent meanwhile
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    async def hold(self, awaitable):
+        """Await a server-side wait (rate limit, memory budget, fan-out) without counting it as silence."""
+        self.holds += 1
+        try:
+            return await awaitable
+        finally:
+            self.holds -= 1
+            self.touch()
+
+# Rate limits per user {username: (message_bucket, byte_bucket)}, kept across reconnects
+rate_limits = {}
+
+def user_rate_limits(username):
+    """Return a user's (message_bucket, byte_bucket), creating them on first use."""
+    buckets = rate_limits.pop(username, None)
+    if buckets is None:
+        buckets = (TokenBucket(MSG_RATE, MSG_BURST), TokenBucket(BYTE_RATE, BYTE_BURST))
+    rate_limits[username] = buckets
+    # Least recently connected first; their buckets have long since refilled,
+    # and live connections hold their own references anyway
+    while len(rate_limits) > MAX_RATE_LIMITS:
+        del rate_limits[next(iter(rate_limits))]
+    return buckets
+
+class Timer:
+    __slots__ = ('deadline', 'callback', 'slot')
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline  # In wheel ticks
+        self.callback = callback
+        self.slot = None  # The wheel slot holding this timer, None once fired or cancelled
+
+class TimerWheel:
+    """Hierarchical timing wheel: O(1) schedule and cancel, one asyncio task for every timer.
+
+    Level 0 has one slot per tick; each higher level has slots covering a whole
+    revolution of the level below. When a lower level wraps, the matching slot
+    of the level above is cascaded down, so each tick only touches the timers
+    that are due (plus, occasionally, one slot being cascaded).
+    """
+
+    def __init__(self, tick, slots=TIMER_SLOTS, levels=TIMER_LEVELS):
+        self.tick = tick
+        self.slots = slots
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.now = 0  # Ticks elapsed
+
+    def schedule(self, delay, callback):
+        """Call ``callback()`` after ``delay`` seconds, rounded up to a whole tick."""
+        timer = Timer(self.now + max(1, math.ceil(delay / self.tick)), callback)
+        self._place(timer)
+        return timer
+
+    def cancel(self, timer):
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+
+    def _place(self, timer):
+        remaining = timer.deadline - self.now
+        for level, wheel in enumerate(self.wheels):
+            # Timers beyond the top level's range wait there and get re-placed on each cascade
+            if remaining < self.slots ** (level + 1) or level == len(self.wheels) - 1:
+                timer.slot = wheel[(timer.deadline // self.slots ** level) % self.slots]
+                timer.slot.add(timer)
+                return
+
+    def advance(self):
+        """Move forward one tick and fire the timers that are due."""
+        self.now += 1
+        for level in range(1, len(self.wheels)):
+            if self.now % self.slots ** level:
+                break
+            slot = self.wheels[level][(self.now // self.slots ** level) % self.slots]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._place(timer)
+        slot = self.wheels[0][self.now % self.slots]
+        expired = list(slot)
+        slot.clear()
+        for timer in expired:
+            timer.slot = None
+            try:
+                timer.callback()
+            except Exception as e:
+                print(f"Error in timer callback: {e}")
+
+    async def run(self):
+        """Advance in real time, catching up on ticks missed while the loop was busy."""
+        start = time.monotonic()
+        while True:
+            await asyncio.sleep(self.tick)
+            target = int((time.monotonic() - start) / self.tick)
+            while self.now < target:
+                self.advance()
+
+# Heartbeat, idle and write-stall timers for all connections; driven from main()
+timers = TimerWheel(TIMER_TICK)
+
+# Writers in the middle of a FILE:/DIR:/HIST: stream; nothing else may interleave with them
+# {writer: event set when the stream ends}
+outbound_transfers = {}
+
+# Lines held back for writers in outbound_transfers {writer: [line, ...]}
+deferred_lines = {}
+
+async def begin_transfer(writer):
+    """Claim a writer for a stream, waiting for any stream already going to it."""
+    while writer in outbound_transfers:
+        await outbound_transfers[writer].wait()
+    outbound_transfers[writer] = asyncio.Event()
+
+def end_transfer(writer):
+    """Mark a stream finished and release the lines held back while it ran."""
+    finished = outbound_transfers.pop(writer)
+    lines = deferred_lines.pop(writer, ())
+    if lines and not writer.is_closing():
+        writer.write(b''.join(lines))
+    finished.set()
+
+def send_line(writer, line):
+    """Write a protocol line, or hold it back until the writer's current transfer ends; True if written now."""
+    if writer not in outbound_transfers:
+        writer.write(line)
+        return True
+    lines = deferred_lines.setdefault(writer, [])
+    if len(lines) < MAX_DEFERRED_LINES:
+        lines.append(line)
+    else:
+        print(f"Dropped a line for a client mid-transfer: {MAX_DEFERRED_LINES} already waiting")
+    return False
+
+async def drain(writer):
+    """writer.drain() that aborts the connection if the peer stops reading for WRITE_TIMEOUT."""
+    timer = timers.schedule(WRITE_TIMEOUT, writer.transport.abort)
+    try:
+        await writer.drain()
+    finally:
+        timers.cancel(timer)
+
+def evict_client(username, reader, writer):
+    """Free a dead client's username at once and tear down its connection."""
+    if username in active_clients and active_clients[username][0] is reader:
+        del active_clients[username]
+        channels.leave_all(username)
+    writer.transport.abort()
+
+class ChannelRouter:
+    """Subscription index for named channels: channel -> members and user -> channels."""
+
+    def __init__(self):
+        self.channels = {}  # channel -> set of usernames
+        self.subscriptions = {}  # username -> set of channels
+
+    def join(self, username, channel):
+        self.channels.setdefault(channel, set()).add(username)
+        self.subscriptions.setdefault(username, set()).add(channel)
+
+    def leave(self, username, channel):
+        joined = self.subscriptions.get(username)
+        if joined is None or channel not in joined:
+            return
+        joined.discard(channel)
+        if not joined:
+            del self.subscriptions[username]
+        self._drop_member(channel, username)
+
+    def leave_all(self, username):
+        """Remove a user from every channel they joined, e.g. on disconnect."""
+        for channel in self.subscriptions.pop(username, ()):
+            self._drop_member(channel, username)
+
+    def _drop_member(self, channel, username):
+        members = self.channels[channel]
+        members.discard(username)
+        if not members:
+            del self.channels[channel]
+
+    def members(self, channel):
+        return self.channels.get(channel, ())
+
+# Channel subscriptions shared by all connections
+channels = ChannelRouter()
+
+async def stream_history(writer, records):
+    """Send history records as HIST: lines and an ENDOFHISTORY: trailer."""
+    # Stream the reply as a transfer, so console sends to this client can't
+    # land in the middle of it or it in theirs
+    await begin_transfer(writer)
+    try:
+        count = 0
+        for line in records:
+            writer.write(b'HIST:' + line)
+            count += 1
+            if count % HISTORY_BATCH == 0:
+                await drain(writer)
+        writer.write(f"ENDOFHISTORY:{count}\n".encode())
+        await drain(writer)
+    finally:
+        end_transfer(writer)
+
+async def publish(channel, sender_name, message):
+    """Fan a message out to every other member of a channel, draining them concurrently."""
+    targets = []
+    count = 0
+    for name in channels.members(channel):
+        if name != sender_name and name in active_clients:
+            _, target_writer, _, target_clock = active_clients[name]
+            target_clock.increment()
+            line = f"CHAN:{channel}:{sender_name}:{message}:{target_clock.get_clock()}".encode() + b'\n'
+            # Members receiving a FILE:/DIR: stream get the line once it ends
+            if send_line(target_writer, line):
+                targets.append(target_writer)
+            count += 1
+    # Writes are queued above without awaiting, so membership can't change mid fan-out
+    await asyncio.gather(*(drain(target_writer) for target_writer in targets), return_exceptions=True)
+    return count
+
+def build_manifest(root):
+    """Walk a directory tree and return [(relative_path, size), ...] in a stable order.
+
+    Directories with nothing else to send are listed as ``(relative_path + '/', 0)``
+    so the receiver can recreate them.
+    """
+    manifest = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        listed = len(manifest)
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, root).replace(os.sep, '/')
+            try:
+                size = os.path.getsize(path)
+            except OSError as e:
+                # Dangling symlinks and the like have nothing to send
+                print(f"Skipping '{path}': {e}")
+                continue
+            manifest.append((relpath, size))
+        if not dirnames and len(manifest) == listed:
+            manifest.append((os.path.relpath(dirpath, root).replace(os.sep, '/') + '/', 0))
+    return manifest
+
+def iter_file_chunks(path, size):
+    """Yield exactly ``size`` bytes of a file, as listed in the manifest."""
+    remaining = size
+    try:
+        with open(path, "rb") as f:
+            while remaining and (chunk := f.read(min(BUFFER_SIZE, remaining))):
+                remaining -= len(chunk)
+                yield chunk
+    except OSError as e:
+        print(f"Could not read '{path}', sending zeros instead: {e}")
+    # The file shrank, vanished or became unreadable since the manifest was
+    # built; pad it so the stream stays framed
+    while remaining:
+        chunk = bytes(min(BUFFER_SIZE, remaining))
+        remaining -= len(chunk)
+        yield chunk
+
+def iter_manifest_chunks(root, manifest):
+    """Yield the contents of every manifest file back to back, coalesced into BUFFER_SIZE chunks."""
+    pending = bytearray()
+    for relpath, size in manifest:
+        if relpath.endswith('/'):
+            continue  # Directory entry, no contents
+        for chunk in iter_file_chunks(os.path.join(root, relpath), size):
+            pending += chunk
+            if len(pending) >= BUFFER_SIZE:
+                yield bytes(pending)
+                pending.clear()
+    if pending:
+        yield bytes(pending)
+
+async def read_ahead(chunks, queue):
+    """Pull chunks from disk in a worker thread so reads overlap with socket writes."""
+    try:
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            await queue.put(chunk)
+        await queue.put(None)
+    except Exception as e:
+        await queue.put(e)
+
+async def stream_directory(writer, dirname, clock):
+    """Write a DIR: header, the manifest and all file contents as a single stream."""
+    manifest = await asyncio.to_thread(build_manifest, dirname)
+    total = sum(size for _, size in manifest)
+    lines = [
+        f"DIR:{os.path.basename(os.path.normpath(dirname))}:{clock}",
+        f"MANIFEST:{len(manifest)}:{total}",
+    ]
+    lines += [f"{size}:{relpath}" for relpath, size in manifest]
+    await begin_transfer(writer)
+    try:
+        writer.write(("\n".join(lines) + "\n").encode())
+
+        queue = asyncio.Queue(maxsize=READ_AHEAD_CHUNKS)
+        read_task = asyncio.create_task(read_ahead(iter_manifest_chunks(dirname, manifest), queue))
+        try:
+            while (chunk := await queue.get()) is not None:
+                if isinstance(chunk, Exception):
+                    # The peer is mid-stream and can't resync; make it see EOF
+                    writer.transport.abort()
+                    raise chunk
+                writer.write(chunk)
+                await drain(writer)
+        finally:
+            read_task.cancel()
+
+        # Signal end of directory with special marker
+        writer.write(b'ENDOFDIR\n')
+        await drain(writer)
+    finally:
+        end_transfer(writer)
+    return len(manifest), total
+
+def safe_relpath(relpath):
+    """Reject manifest paths that would escape the destination directory."""
+    path = os.path.normpath(relpath)
+    if os.path.isabs(path) or path == os.pardir or path.startswith(os.pardir + os.sep):
+        raise ValueError(f"Unsafe path in manifest: {relpath}")
+    return path
+
+def write_file(path, data):
+    """Write a whole file, creating parent directories as needed."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+async def receive_directory(reader, dirname, byte_bucket, liveness):
+    """Read a manifest and file stream after a DIR: header, writing files in parallel."""
+    root = "received_" + os.path.basename(dirname)
+    header = (await reader.readline()).decode().strip()
+    if not header.startswith("MANIFEST:"):
+        raise ValueError(f"Expected manifest, got: {header}")
+    _, count, total = header.split(':')
+    if int(count) > MAX_MANIFEST_FILES:
+        raise ValueError(f"Directory has {count} files, limit is {MAX_MANIFEST_FILES}")
+    manifest = []
+    manifest_bytes = 0  # Held against memory_budget until the transfer ends
+    writes = set()
+    failures = []  # Write errors, raised only after the whole stream is read so it stays framed
+    slots = asyncio.Semaphore(MAX_PENDING_WRITES)
+    try:
+        for _ in range(int(count)):
+            line = await reader.readline()
+            if manifest_bytes + len(line) > MAX_MANIFEST_BYTES:
+                raise ValueError(f"Directory manifest exceeds {MAX_MANIFEST_BYTES} bytes")
+            await liveness.hold(byte_bucket.consume(len(line)))
+            await liveness.hold(memory_budget.reserve(len(line)))
+            manifest_bytes += len(line)
+            size, relpath = line.decode().rstrip('\n').split(':', 1)
+            # A trailing '/' marks a directory to create rather than a file
+            manifest.append((safe_relpath(relpath), None if relpath.endswith('/') else int(size)))
+
+        for relpath, size in manifest:
+            path = os.path.join(root, relpath)
+            if size is None:
+                try:
+                    await asyncio.to_thread(os.makedirs, path, exist_ok=True)
+                except OSError as e:
+                    failures.append(e)
+            elif size <= INLINE_FILE_SIZE:
+                await liveness.hold(byte_bucket.consume(size))
+                await liveness.hold(slots.acquire())
+                await liveness.hold(memory_budget.reserve(size))
+                try:
+                    data = await reader.readexactly(size)
+                except BaseException:
+                    memory_budget.release(size)
+                    slots.release()
+                    raise
+
+                def written(task, size=size):
+                    memory_budget.release(size)
+                    slots.release()
+                    if not task.cancelled() and task.exception() is not None:
+                        failures.append(task.exception())
+
+                task = asyncio.create_task(asyncio.to_thread(write_file, path, data))
+                writes.add(task)
+                task.add_done_callback(writes.discard)
+                task.add_done_callback(written)
+            else:
+                # Large files are streamed to disk rather than held in memory
+                try:
+                    await asyncio.to_thread(os.makedirs, os.path.dirname(path), exist_ok=True)
+                    f = await asyncio.to_thread(open, path, "wb")
+                except OSError as e:
+                    failures.append(e)
+                    f = None
+                try:
+                    remaining = size
+                    while remaining:
+                        chunk = await reader.readexactly(min(BUFFER_SIZE, remaining))
+                        await liveness.hold(byte_bucket.consume(len(chunk)))
+                        remaining -= len(chunk)
+                        if f is None:
+                            continue  # Keep reading so the stream stays framed
+                        try:
+                            await asyncio.to_thread(f.write, chunk)
+                        except OSError as e:
+                            failures.append(e)
+                            await asyncio.to_thread(f.close)
+                            f = None
+                finally:
+                    if f is not None:
+                        await asyncio.to_thread(f.close)
+
+        trailer = await reader.readline()
+        if trailer != b'ENDOFDIR\n':
+            raise ValueError("Directory stream missing ENDOFDIR marker")
+        await asyncio.gather(*writes, return_exceptions=True)
+        if failures:
+            print(f"{len(failures)} file(s) in '{dirname}' could not be written")
+            raise failures[0]
+    finally:
+        for task in writes:
+            task.cancel()
+        memory_budget.release(manifest_bytes)
+    return root, len(manifest), int(total)
+
 async def handle_client(reader, writer):
     """Handles communication with a connected client asynchronously."""
     addr = writer.get_extra_info('peername')
     client_id = f"{addr[0]}:{addr[1]}"
     print(f"New connection from {client_id}")
     
-    # Wait for client to send their username
-    data = await reader.readline()
+    # Wait for client to send their username, dropping peers that never do
+    handshake_timer = timers.schedule(IDLE_TIMEOUT, writer.transport.abort)
+    try:
+        data = await reader.readline()
+    except (ValueError, ConnectionError):
+        data = b''
+    finally:
+        timers.cancel(handshake_timer)
     if not data:
         print(f"Client {client_id} disconnected before sending username")
         return
@@ -50,7 +767,7 @@ async def handle_client(reader, writer):
         if username in active_clients:
             print(f"Username '{username}' already taken. Connection rejected.")
             writer.write(b"ERROR: Username already taken\n")
-            await writer.drain()
+            await drain(writer)
             writer.close()
             await writer.wait_closed()
             return
@@ -58,12 +775,34 @@ async def handle_client(reader, writer):
         print(f"Client {client_id} identified as '{username}'")
         vector_clock = VectorClock(client_id)
         active_clients[username] = (reader, writer, client_id, vector_clock)
+        message_bucket, byte_bucket = user_rate_limits(username)
+        liveness = Liveness()
     else:
         print(f"Client {client_id} did not properly identify. Connection rejected.")
         writer.close()
         await writer.wait_closed()
         return
 
+    def heartbeat():
+        """Timer callback: evict this client if silent too long, ping it if idle, and re-arm."""
+        nonlocal heartbeat_timer
+        if writer.is_closing():
+            return
+        if writer in outbound_transfers:
+            # Mid-stream: a PING would corrupt it, and drain() already catches a dead reader
+            heartbeat_timer = timers.schedule(HEARTBEAT_INTERVAL, heartbeat)
+            return
+        idle = time.monotonic() - liveness.last_seen
+        if idle >= IDLE_TIMEOUT and not liveness.holds:
+            print(f"Client '{username}' silent for {idle:.0f}s, evicting")
+            evict_client(username, reader, writer)
+            return
+        if idle >= HEARTBEAT_INTERVAL:
+            writer.write(b"PING\n")
+        heartbeat_timer = timers.schedule(HEARTBEAT_INTERVAL, heartbeat)
+
+    heartbeat_timer = timers.schedule(HEARTBEAT_INTERVAL, heartbeat)
+
     async def send_file(filename, target_username):
         """Send a file to the specific client in chunks."""
         if target_username not in active_clients:
@@ -74,22 +813,41 @@ async def handle_client(reader, writer):
         
         if os.path.exists(filename):
             target_clock.increment()
-            target_writer.write(f"FILE:{filename}:{target_clock.get_clock()}".encode() + b'\n')
-            await target_writer.drain()
-            
-            with open(filename, "rb") as f:
-                while chunk := f.read(BUFFER_SIZE):
-                    target_writer.write(chunk)
-                    await target_writer.drain()
-            
-            # Signal end of file with special marker
-            target_writer.write(b'ENDOFFILE\n')
-            await target_writer.drain()
+            await begin_transfer(target_writer)
+            try:
+                target_writer.write(f"FILE:{filename}:{target_clock.get_clock()}".encode() + b'\n')
+                await drain(target_writer)
+                
+                with open(filename, "rb") as f:
+                    while chunk := f.read(BUFFER_SIZE):
+                        target_writer.write(chunk)
+                        await drain(target_writer)
+                
+                # Signal end of file with special marker
+                target_writer.write(b'ENDOFFILE\n')
+                await drain(target_writer)
+            finally:
+                end_transfer(target_writer)
             
             print(f"Sent file '{filename}' to '{target_username}'")
         else:
             print("File not found.")
 
+    async def send_directory(dirname, target_username):
+        """Send a whole directory tree to the specific client as one batched stream."""
+        if target_username not in active_clients:
+            print(f"Client '{target_username}' is no longer connected")
+            return
+            
+        _, target_writer, _, target_clock = active_clients[target_username]
+        
+        if os.path.isdir(dirname):
+            target_clock.increment()
+            count, total = await stream_directory(target_writer, dirname, target_clock.get_clock())
+            print(f"Sent directory '{dirname}' ({count} files, {total} bytes) to '{target_username}'")
+        else:
+            print("Directory not found.")
+
     async def list_clients():
         """Display a list of all connected clients."""
         if not active_clients:
@@ -99,6 +857,10 @@ async def handle_client(reader, writer):
         print("\nConnected clients:")
         for i, (name, _) in enumerate(active_clients.items(), 1):
             print(f"{i}. {name}")
+        if channels.channels:
+            print("\nChannels:")
+            for channel, members in channels.channels.items():
+                print(f"#{channel} ({len(members)} members)")
         print()
 
     async def sender():
@@ -106,27 +868,29 @@ async def handle_client(reader, writer):
         try:
             while True:
                 action = await aioconsole.ainput(
-                    "\nActions:\n1. List clients\n2. Send message\n3. Send file\n4. Disconnect client\n5. Exit\nChoose action (1-5): "
+                    "\nActions:\n1. List clients\n2. Send message\n3. Send file\n4. Send directory\n5. Disconnect client\n6. Exit\nChoose action (1-6): "
                 )
                 
                 if action == "1":  # List clients
                     await list_clients()
                     continue
                 
-                elif action == "2" or action == "3":  # Send message or file
+                elif action in ("2", "3", "4"):  # Send message, file or directory
                     # First list available clients
                     await list_clients()
                     if not active_clients:
                         continue
                         
                     targets = await aioconsole.ainput(
-                        "Enter client username(s) to send to (separate multiple with commas, or type 'all'): "
+                        "Enter client username(s) to send to (separate multiple with commas, type 'all', or '#channel'): "
                     )
                     
                     # Determine target clients
                     target_usernames = []
                     if targets.lower() == 'all':
                         target_usernames = list(active_clients.keys())
+                    elif targets.startswith('#'):
+                        target_usernames = [name for name in channels.members(targets[1:]) if name in active_clients]
                     else:
                         target_usernames = [name.strip() for name in targets.split(',')]
                         # Filter out invalid usernames
@@ -141,18 +905,40 @@ async def handle_client(reader, writer):
                         for username in target_usernames:
                             if username in active_clients:
                                 _, target_writer, _, target_clock = active_clients[username]
+                                if target_writer.is_closing():
+                                    continue
                                 target_clock.increment()
-                                target_writer.write(f"MSG:{message}:{target_clock.get_clock()}".encode() + b'\n')
-                                await target_writer.drain()
+                                send_line(target_writer, f"MSG:{message}:{target_clock.get_clock()}".encode() + b'\n')
+                                try:
+                                    await drain(target_writer)
+                                except ConnectionError as e:
+                                    # Dead writer aborted by the write timeout; carry on with the rest
+                                    print(f"Could not send to '{username}': {e}")
+                                    continue
+                                if target_writer.is_closing():
+                                    print(f"Could not send to '{username}': connection closed")
+                                    continue
                                 print(f"Message sent to '{username}'")
                             
                     elif action == "3":  # Send file
                         filename = await aioconsole.ainput("Enter filename to send: ")
                         for username in target_usernames:
                             if username in active_clients:
-                                await send_file(filename, username)
+                                try:
+                                    await send_file(filename, username)
+                                except ConnectionError as e:
+                                    print(f"Could not send to '{username}': {e}")
+                    
+                    elif action == "4":  # Send directory
+                        dirname = await aioconsole.ainput("Enter directory to send: ")
+                        for username in target_usernames:
+                            if username in active_clients:
+                                try:
+                                    await send_directory(dirname, username)
+                                except OSError as e:
+                                    print(f"Could not send to '{username}': {e}")
                 
-                elif action == "4":  # Disconnect client
+                elif action == "5":  # Disconnect client
                     await list_clients()
                     if not active_clients:
                         continue
@@ -161,24 +947,27 @@ async def handle_client(reader, writer):
                     if username in active_clients:
                         _, target_writer, _, _ = active_clients[username]
                         target_writer.write(b"Server closed the connection\n")
-                        await target_writer.drain()
+                        try:
+                            await drain(target_writer)
+                        except ConnectionError:
+                            pass  # Already gone
                         print(f"Disconnected '{username}'")
                     else:
                         print(f"Client '{username}' not found")
                 
-                elif action == "5":  # Exit server
+                elif action == "6":  # Exit server
                     print("Shutting down server...")
                     # Notify all clients
-                    for name, (_, client_writer, _, _) in active_clients.items():
+                    for name, (_, client_writer, _, _) in list(active_clients.items()):
                         try:
                             client_writer.write(b"Server shutting down\n")
-                            await client_writer.drain()
+                            await drain(client_writer)
                         except:
                             pass
                     break
                 
                 else:
-                    print("Invalid option. Please choose 1-5.")
+                    print("Invalid option. Please choose 1-6.")
                     
         except asyncio.CancelledError:
             pass
@@ -189,39 +978,115 @@ async def handle_client(reader, writer):
         """Handle receiving messages from this client."""
         try:
             while True:
-                data = await reader.readline()
+                try:
+                    data = await reader.readline()
+                except ValueError:
+                    # Endless or oversized line: drop the client rather than buffer it
+                    username = next((name for name, (r, w, _, _) in active_clients.items() if r is reader), None)
+                    print(f"Client '{username}' sent a line longer than {MAX_LINE_SIZE} bytes")
+                    break
                 if not data:
                     username = next((name for name, (r, w, _, _) in active_clients.items() if r is reader), None)
                     if username:
                         print(f"Client '{username}' disconnected")
                         del active_clients[username]
+                        channels.leave_all(username)
                     break
+                liveness.touch()  # Any line, including PONG, shows the client is alive
                 
-                message = data.decode().strip()
+                # Admission control: pace this user, and hold the line against the global budget
+                await liveness.hold(message_bucket.consume(1))
+                await liveness.hold(byte_bucket.consume(len(data)))
+                await liveness.hold(memory_budget.reserve(len(data)))
+                try:
+                    message = data.decode().strip()
                 
-                if message.startswith("FILE:"):
-                    parts = message.split(':', 2)
-                    filename = parts[1]
-                    sender_clock = eval(parts[2])
-                    username = next((name for name, (r, w, _, _) in active_clients.items() if r is reader), None)
-                    print(f"\nReceiving file from '{username}': {filename}")
-                    with open("received_" + filename, "wb") as f:
-                        while True:
-                            chunk = await reader.readuntil(b'ENDOFFILE\n')
-                            if chunk.endswith(b'ENDOFFILE\n'):
-                                f.write(chunk[:-10])  # Remove the ENDOFFILE marker
-                                break
-                            f.write(chunk)
-                    print(f"Received file: received_{filename} from '{username}'")
-                    active_clients[username][3].update(sender_clock)
+                    if message.startswith("FILE:"):
+                        parts = message.split(':', 2)
+                        filename = parts[1]
+                        sender_clock = eval(parts[2])
+                        username = next((name for name, (r, w, _, _) in active_clients.items() if r is reader), None)
+                        print(f"\nReceiving file from '{username}': {filename}")
+                        with open("received_" + filename, "wb") as f:
+                            while True:
+                                chunk = await reader.readuntil(b'ENDOFFILE\n')
+                                await liveness.hold(byte_bucket.consume(len(chunk)))
+                                if chunk.endswith(b'ENDOFFILE\n'):
+                                    f.write(chunk[:-10])  # Remove the ENDOFFILE marker
+                                    break
+                                f.write(chunk)
+                        print(f"Received file: received_{filename} from '{username}'")
+                        active_clients[username][3].update(sender_clock)
                 
-                elif message.startswith("MSG:"):
-                    parts = message.split(':', 2)
-                    msg = parts[1]
-                    sender_clock = eval(parts[2])
-                    username = next((name for name, (r, w, _, _) in active_clients.items() if r is reader), None)
-                    print(f"\n{username}: {msg}")
-                    active_clients[username][3].update(sender_clock)
+                    elif message.startswith("DIR:"):
+                        parts = message.split(':', 2)
+                        dirname = parts[1]
+                        sender_clock = eval(parts[2])
+                        username = next((name for name, (r, w, _, _) in active_clients.items() if r is reader), None)
+                        print(f"\nReceiving directory from '{username}': {dirname}")
+                        try:
+                            root, count, total = await receive_directory(reader, dirname, byte_bucket, liveness)
+                        except OSError as e:
+                            # The stream was read to its end, so the connection is still usable
+                            print(f"Failed to save directory '{dirname}' from '{username}': {e}")
+                        else:
+                            print(f"Received directory: {root} ({count} files, {total} bytes) from '{username}'")
+                        active_clients[username][3].update(sender_clock)
+                
+                    elif message.startswith("MSG:"):
+                        parts = message.split(':', 2)
+                        msg = parts[1]
+                        sender_clock = eval(parts[2])
+                        username = next((name for name, (r, w, _, _) in active_clients.items() if r is reader), None)
+                        print(f"\n{username}: {msg}")
+                        active_clients[username][3].update(sender_clock)
+                        try:
+                            history.append(username, msg, sender_clock)
+                        except ValueError as e:
+                            print(f"Message from '{username}' not logged: {e}")
+                
+                    elif message.startswith("JOIN:") or message.startswith("LEAVE:"):
+                        command, _, channel = message.partition(':')
+                        username = next((name for name, (r, w, _, _) in active_clients.items() if r is reader), None)
+                        if not channel or ':' in channel or ' ' in channel:
+                            print(f"Invalid channel name from '{username}': {channel}")
+                        elif command == "JOIN":
+                            channels.join(username, channel)
+                            print(f"'{username}' joined #{channel}")
+                        else:
+                            channels.leave(username, channel)
+                            print(f"'{username}' left #{channel}")
+                
+                    elif message.startswith("PUB:"):
+                        # PUB:<channel>:<message>:<clock>; the clock is the last ':{...}'
+                        channel, _, rest = message[4:].partition(':')
+                        split = rest.rfind(':{')
+                        msg = rest[:split]
+                        sender_clock = eval(rest[split + 1:])
+                        username = next((name for name, (r, w, _, _) in active_clients.items() if r is reader), None)
+                        active_clients[username][3].update(sender_clock)
+                        if username not in channels.members(channel):
+                            print(f"'{username}' is not in #{channel}; message dropped")
+                            continue
+                        count = await liveness.hold(publish(channel, username, msg))
+                        print(f"\n#{channel} {username}: {msg} ({count} recipients)")
+                
+                    elif message.startswith("HISTORY:"):
+                        # HISTORY:LAST:<n>, HISTORY:SINCE:<clock> or HISTORY:USER:<username>:<n>
+                        kind, _, arg = message[8:].partition(':')
+                        if kind == "LAST":
+                            records = history.last(int(arg))
+                        elif kind == "SINCE":
+                            records = history.since(eval(arg))
+                        elif kind == "USER":
+                            name, _, count = arg.rpartition(':')
+                            records = history.user_last(name, int(count))
+                        else:
+                            print(f"Unknown history query: {message}")
+                            continue
+                        await liveness.hold(stream_history(writer, records))
+                finally:
+                    memory_budget.release(len(data))
         
         except asyncio.CancelledError:
             pass
@@ -230,6 +1095,7 @@ async def handle_client(reader, writer):
             print(f"Error in receiver for '{username}': {e}")
             if username in active_clients:
                 del active_clients[username]
+                channels.leave_all(username)
 
     # Create tasks for sending and receiving
     send_task = asyncio.create_task(sender())
@@ -239,18 +1105,23 @@ async def handle_client(reader, writer):
         # Wait for either task to finish
         await asyncio.gather(send_task, receive_task, return_exceptions=True)
     finally:
+        timers.cancel(heartbeat_timer)
         send_task.cancel()
         receive_task.cancel()
         username = next((name for name, (r, w, _, _) in active_clients.items() if r is reader), None)
         if username in active_clients:
             del active_clients[username]
+            channels.leave_all(username)
         writer.close()
         await writer.wait_closed()
         print(f"Connection with '{username}' closed")
 
 async def main():
     """Main function to start the asynchronous server."""
-    server = await asyncio.start_server(handle_client, HOST, PORT)
+    history.load()
+    commit_task = asyncio.create_task(history.run())
+    timer_task = asyncio.create_task(timers.run())
+    server = await asyncio.start_server(handle_client, HOST, PORT, limit=MAX_LINE_SIZE)
     addr = server.sockets[0].getsockname()
     print(f"Server running on {addr}...")
 